@@ -2,12 +2,50 @@ import streamlit as st
 import pystac_client
 import planetary_computer
 import rasterio
+from rasterio.crs import CRS
+from rasterio.errors import RasterioIOError, WindowError
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box, shape
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 import numpy as np
 import pandas as pd
-import plotly.express as px
-import matplotlib.pyplot as plt
+import plotly.graph_objects as go
 import matplotlib.colors as mcolors
+from PIL import Image
 import io 
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# GDAL tuning for reading Cloud-Optimized GeoTIFFs over HTTP
+GDAL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "CPL_VSIL_CURL_USE_HEAD": "NO",
+    "VSI_CACHE": "TRUE",
+}
+
+# Scenes are downloaded in parallel (network-bound, GDAL releases the GIL)
+MAX_WORKERS = 16
+
+# Skip scenes whose data footprint covers less than this fraction of the river bbox
+MIN_COVERAGE = 0.5
+
+# Read at 1/8 resolution; GDAL serves this from the COGs' internal overviews
+DOWNSAMPLE = 8
+
+# Trend chart draws at most this many points (strided); WebGL handles the rest
+MAX_CHART_POINTS = 200
+
+# NDTI heatmap colours as a 256-entry RGBA uint8 lookup table over [NDTI_MIN, NDTI_MAX]
+NDTI_MIN, NDTI_MAX = -0.1, 0.3
+NDTI_CMAP = mcolors.LinearSegmentedColormap.from_list("galamsey", ["blue", "cyan", "yellow", "red", "brown"])
+NDTI_LUT = NDTI_CMAP(np.linspace(0, 1, 256), bytes=True)
 
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="Galamsey Sentinel Pro", page_icon="🛰️", layout="wide")
@@ -48,12 +86,16 @@ mask_threshold = st.sidebar.slider(
 )
 
 # --- FUNCTIONS ---
-@st.cache_data
-def fetch_satellite_data(bbox, year, cloud_cover):
-    catalog = pystac_client.Client.open(
+@st.cache_resource
+def get_catalog():
+    return pystac_client.Client.open(
         "https://planetarycomputer.microsoft.com/api/stac/v1",
         modifier=planetary_computer.sign_inplace
     )
+
+@st.cache_data
+def fetch_satellite_data(bbox, year, cloud_cover):
+    catalog = get_catalog()
     search = catalog.search(
         collections=["sentinel-2-l2a"],
         bbox=bbox,
@@ -61,45 +103,123 @@ def fetch_satellite_data(bbox, year, cloud_cover):
         query={"eo:cloud_cover": {"lt": cloud_cover}}, 
     )
     items = search.item_collection()
+    items = [item for item in items if bbox_coverage(item, bbox) >= MIN_COVERAGE]
     return sorted(items, key=lambda i: i.properties["datetime"])
 
-def normalize(band):
-    """Normalize band for RGB display"""
-    band = band.astype(float)
-    return (band - band.min()) / (band.max() - band.min())
+def bbox_coverage(item, bbox):
+    """Fraction of the bbox inside the scene's data footprint (from STAC metadata, no download)"""
+    river = box(*bbox)
+    return shape(item.geometry).intersection(river).area / river.area
+
+def stretch_rgb(red, green, blue):
+    """2-98% percentile stretch of the RGB bands straight to a uint8 display image"""
+    rgb = np.dstack((red, green, blue)).astype(np.float32)
+    lo, hi = np.percentile(rgb, (2, 98), axis=(0, 1))
+    rgb -= lo
+    rgb *= 255 / (hi - lo)
+    return np.clip(rgb, 0, 255, out=rgb).astype(np.uint8)
+
+def bbox_window(bbox, crs, transform, width, height):
+    """Pixel window of the river bbox (lon/lat) on the scene grid"""
+    bounds = transform_bounds("EPSG:4326", crs, *bbox)
+    window = from_bounds(*bounds, transform=transform)
+    return window.round_offsets().round_lengths().intersection(Window(0, 0, width, height))
+
+def band_stack_vrt(hrefs, crs, transform, width, height):
+    """VRT XML stacking single-band COGs (same grid) as the bands of one dataset"""
+    bands = "".join(
+        f'<VRTRasterBand dataType="UInt16" band="{i}"><SimpleSource>'
+        f'<SourceFilename relativeToVRT="0">/vsicurl/{escape(href)}</SourceFilename>'
+        f'<SourceBand>1</SourceBand></SimpleSource></VRTRasterBand>'
+        for i, href in enumerate(hrefs, start=1)
+    )
+    return (
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+        f'<SRS>{escape(crs.to_wkt())}</SRS>'
+        f'<GeoTransform>{", ".join(map(str, transform.to_gdal()))}</GeoTransform>'
+        f'{bands}</VRTDataset>'
+    )
 
-def process_image(item):
+@st.cache_data(persist="disk", max_entries=2000, show_spinner=False)
+@retry(retry=retry_if_exception_type(RasterioIOError), stop=stop_after_attempt(3),
+       wait=wait_exponential(multiplier=0.5, max=4), reraise=True)
+def load_scene(item_id, bbox, downsample, _hrefs, _grid):
+    """Download the bands of one scene over bbox. Cached on disk on (item_id, bbox, downsample); signed hrefs change per search."""
+    epsg, transform, width, height = _grid
+    crs = CRS.from_epsg(epsg)
+    window = bbox_window(bbox, crs, transform, width, height)
+    vrt = band_stack_vrt(_hrefs, crs, transform, width, height)
+
+    # Read all bands in one call (downsampled, river window only)
+    with rasterio.Env(**GDAL_OPTIONS), MemoryFile(vrt.encode(), ext=".vrt") as mem, mem.open() as src:
+        out_shape = (src.count, max(int(window.height) // downsample, 1), max(int(window.width) // downsample, 1))
+        red, green, blue, nir = src.read(window=window, out_shape=out_shape)
+
+    return red, green, blue, nir
+
+def process_image(item, bbox):
     # Fetch bands
-    href_blue = item.assets["B02"].href
-    href_green = item.assets["B03"].href
-    href_red = item.assets["B04"].href
-    href_nir = item.assets["B08"].href
-
-    # Read bands (downsampled 8x)
-    with rasterio.open(href_red) as src:
-        red = src.read(1, out_shape=(src.height // 8, src.width // 8))
-    with rasterio.open(href_green) as src:
-        green = src.read(1, out_shape=(src.height // 8, src.width // 8))
-    with rasterio.open(href_blue) as src:
-        blue = src.read(1, out_shape=(src.height // 8, src.width // 8))
-    with rasterio.open(href_nir) as src:
-        nir = src.read(1, out_shape=(src.height // 8, src.width // 8))
+    hrefs = (
+        item.assets["B04"].href,
+        item.assets["B03"].href,
+        item.assets["B02"].href,
+        item.assets["B08"].href,
+    )
+    
+    # Scene grid from the STAC projection metadata (shared by the 10 m bands)
+    height, width = item.assets["B04"].extra_fields["proj:shape"]
+    transform = Affine(*item.assets["B04"].extra_fields["proj:transform"][:6])
+    grid = (item.properties["proj:epsg"], transform, width, height)
+    
+    # Get Metadata
+    cloud_pct = item.properties.get("eo:cloud_cover", 0)
+    
+    red, green, blue, nir = load_scene(item.id, tuple(bbox), DOWNSAMPLE, hrefs, grid)
+    return red, green, blue, nir, item.datetime, cloud_pct
 
+def river_turbidity(red, green, nir, threshold):
+    """Mean NDTI over water pixels (NDWI > threshold) and the water pixel count"""
+    # NDWI > t  <=>  (G - N) > t * (G + N), as G + N >= 0: no full NDWI array needed.
+    # Evaluated exactly in integers on the uint16 bands, with t scaled by 1e4
+    # (the slider moves in 0.01 steps; products stay well inside int32).
+    t = round(threshold * 10000)
+    gn_diff = np.subtract(green, nir, dtype=np.int32)
+    gn_diff *= 10000
+    gn_sum = np.add(green, nir, dtype=np.int32)
+    gn_sum *= t
+    water = gn_diff > gn_sum
+    
+    n_water = np.count_nonzero(water)
+    if n_water == 0:
+        return np.nan, 0
+    
+    # NDTI only for the water pixels (0 elsewhere), summed in one pass; no
+    # masked copy. Water implies G > 0 (for t > -1), so R + G is never 0 there.
+    num = np.subtract(red, green, dtype=np.float32)
+    den = np.add(red, green, dtype=np.float32)
+    ndti = np.divide(num, den, out=np.zeros_like(num), where=water)
+    
+    return ndti.sum() / n_water, n_water
+
+def compute_indices(red, green, nir):
+    """Full NDTI/NDWI rasters, for the heatmap view"""
     np.seterr(divide='ignore', invalid='ignore')
-    r, g, b, n = red.astype(float), green.astype(float), blue.astype(float), nir.astype(float)
+    r = red.astype(np.float32, copy=False)
+    g = green.astype(np.float32, copy=False)
+    n = nir.astype(np.float32, copy=False)
     
     # Indices
     ndti = (r - g) / (r + g) 
     ndwi = (g - n) / (g + n) 
     
-    # Create RGB Stack
-    rgb = np.dstack((normalize(r), normalize(g), normalize(b))) * 3.5
-    rgb = np.clip(rgb, 0, 1)
-    
-    # Get Metadata
-    cloud_pct = item.properties.get("eo:cloud_cover", 0)
-    
-    return ndti, ndwi, rgb, item.datetime, cloud_pct
+    return ndti, ndwi
+
+def colorize_ndti(ndti, water):
+    """NDTI heatmap as an RGBA uint8 image, transparent outside the water mask"""
+    idx = np.clip((ndti - NDTI_MIN) * (255 / (NDTI_MAX - NDTI_MIN)), 0, 255)
+    rgba = NDTI_LUT[np.nan_to_num(idx).astype(np.uint8)]
+    rgba[~water, 3] = 0
+    return rgba
 
 # --- MAIN APP LOGIC ---
 
@@ -113,24 +233,42 @@ if st.sidebar.button("Run Analysis", type="primary"):
         st.success(f"Processing {len(items)} scenes...")
         
         progress_bar = st.progress(0)
-        results = []
         
-        for i, item in enumerate(items):
-            try:
-                ndti, ndwi, rgb, date, cloud = process_image(item)
-                river_pixels = ndti[ndwi > mask_threshold]
-                
-                if len(river_pixels) > 50:
-                    avg_turbidity = np.nanmean(river_pixels)
-                    if -0.5 < avg_turbidity < 0.8:
-                        results.append({"Date": date, "Turbidity": avg_turbidity})
-            except:
-                pass
-            progress_bar.progress((i + 1) / len(items))
+        # One slot per scene (items are date-sorted); NaN marks unusable scenes
+        dates = pd.to_datetime([item.datetime for item in items])
+        turbidity = np.full(len(items), np.nan, dtype=np.float32)
+        
+        # Bands of the latest processed scene, kept for the map view
+        last_index, last_payload = -1, None
+        st.session_state["failed"] = []
+        
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(process_image, item, bbox): idx for idx, item in enumerate(items)}
             
-        if results:
-            df = pd.DataFrame(results)
-            df = df.sort_values("Date")
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    idx = futures[future]
+                    payload = future.result()
+                    if idx > last_index:
+                        last_index, last_payload = idx, payload
+                    
+                    red, green, blue, nir, date, cloud = payload
+                    avg_turbidity, n_water = river_turbidity(red, green, nir, mask_threshold)
+                    
+                    if n_water > 50:
+                        if -0.5 < avg_turbidity < 0.8:
+                            turbidity[idx] = avg_turbidity
+                except (RasterioIOError, WindowError) as e:
+                    st.session_state["failed"].append((items[idx].id, str(e)))
+                progress_bar.progress((i + 1) / len(items))
+        
+        if st.session_state["failed"]:
+            st.warning(f"Skipped {len(st.session_state['failed'])} scene(s) that could not be read.")
+            
+        valid = ~np.isnan(turbidity)
+        
+        if valid.any():
+            df = pd.DataFrame({"Date": dates[valid], "Turbidity": turbidity[valid]})
             
             # METRICS
             avg_annual = df["Turbidity"].mean()
@@ -148,33 +286,28 @@ if st.sidebar.button("Run Analysis", type="primary"):
             # LATEST MAP VIEW
             st.subheader(f"🗺️ Satellite View: {view_mode}")
             
-            # Process latest image
-            last_item = items[-1]
-            ndti, ndwi, rgb, date, cloud_pct = process_image(last_item)
+            # Latest image (already in memory, no re-download)
+            red, green, blue, nir, date, cloud_pct = last_payload
             date_str = date.strftime('%Y-%m-%d')
             
             col_map, col_info = st.columns([3, 1])
             
             with col_map:
-                fig_map, ax = plt.subplots(figsize=(10, 8))
-                
                 if view_mode == "True Color (RGB)":
-                    ax.imshow(rgb)
-                    ax.set_title(f"True Color: {date_str} (Clouds: {cloud_pct}%)")
+                    image = stretch_rgb(red, green, blue)
+                    caption = f"True Color: {date_str} (Clouds: {cloud_pct}%)"
                     filename = f"TrueColor_{selected_river}_{date_str}.png"
                 else:
-                    masked_ndti = np.ma.masked_where(ndwi <= mask_threshold, ndti)
-                    cmap = mcolors.LinearSegmentedColormap.from_list("galamsey", ["blue", "cyan", "yellow", "red", "brown"])
-                    ax.imshow(masked_ndti, cmap=cmap, vmin=-0.1, vmax=0.3)
-                    ax.set_title(f"Turbidity Heatmap: {date_str}")
+                    ndti, ndwi = compute_indices(red, green, nir)
+                    image = colorize_ndti(ndti, ndwi > mask_threshold)
+                    caption = f"Turbidity Heatmap: {date_str}"
                     filename = f"Heatmap_{selected_river}_{date_str}.png"
                 
-                ax.axis('off')
-                st.pyplot(fig_map)
+                st.image(image, caption=caption, use_container_width=True)
                 
                 # DOWNLOAD IMAGE BUTTON
                 buf = io.BytesIO()
-                fig_map.savefig(buf, format="png", bbox_inches='tight', dpi=150)
+                Image.fromarray(image).save(buf, format="PNG", compress_level=1)
                 buf.seek(0)
                 
                 st.download_button(
@@ -211,8 +344,11 @@ if st.sidebar.button("Run Analysis", type="primary"):
             # TREND CHART
             st.divider()
             st.subheader(f"📉 Annual Trend ({year})")
-            fig = px.line(df, x="Date", y="Turbidity", markers=True)
+            stride = -(-len(df) // MAX_CHART_POINTS)
+            df_plot = df.iloc[::stride]
+            fig = go.Figure(go.Scattergl(x=df_plot["Date"], y=df_plot["Turbidity"], mode="lines+markers"))
             fig.update_traces(line_color='#8B4513', line_width=3)
+            fig.update_layout(xaxis_title="Date", yaxis_title="Turbidity", uirevision="const")
             fig.add_hrect(y0=0.1, y1=0.5, line_width=0, fillcolor="red", opacity=0.1, annotation_text="Heavy Galamsey")
             
             st.plotly_chart(fig, use_container_width=True)